@@ -10,6 +10,7 @@ Version:    0.3
 """
 
 import RPi.GPIO as gpio
+import os
 import time
 
 
@@ -17,6 +18,13 @@ class PreciseDispenser:
     """
     A simple class definition to interact with the canine treat dispenser.
     """
+    __slots__ = ("step_width", "spin_threshold", "realtime_priority", "_next_edge", "loaded_treats", "dispensing_timeout",
+                 "start", "ENABLE", "RESET", "SLEEP", "STEP", "DIR", "TREAT", "step_check",
+                 "stop_thread")
+    # Steps the wheel is allowed to turn while waiting for one treat, and steps in one fixed treat hole advance
+    TREAT_STEPS = 54
+    ANGLE_STEPS = 53
+
     def __init__(self, loaded_treats=59, timeout=3):
         """
         Initializer for the canine treat dispenser, configures control variables and Pi GPIO.
@@ -25,9 +33,12 @@ class PreciseDispenser:
         """
         # Set control variables
         self.step_width = 0.005
+        self.spin_threshold = 0.0005
+        self.realtime_priority = 50
+        self._next_edge = 0
         self.loaded_treats = loaded_treats
         self.dispensing_timeout = timeout
-        self.dispensing_start = 0
+        self.start = 0
         # Setup pin definitions
         self.ENABLE = 24
         self.RESET = 23
@@ -44,48 +55,86 @@ class PreciseDispenser:
         gpio.setup(self.RESET, gpio.OUT)
         gpio.setup(self.SLEEP, gpio.OUT)
         # Set outputs and trigger events
-        gpio.add_event_detect(self.TREAT, gpio.FALLING, callback=self.treat_dispensed, bouncetime=100)
+        gpio.add_event_detect(self.TREAT, gpio.FALLING, bouncetime=100)
         gpio.output(self.DIR, gpio.LOW)
         gpio.output(self.ENABLE, gpio.LOW)
         gpio.output(self.RESET, gpio.HIGH)
         gpio.output(self.SLEEP, gpio.HIGH)
-        # Initialize the dispensing variable to False
-        self.dispensing = False
+        # Initialize the step counter, carries leftover steps between treats
         self.step_check = 0
+        self.stop_thread = False
 
     def edge_wait_thread(self):
         gpio.wait_for_edge(self.TREAT, gpio.FALLING)
 
     def dispense_treat_angle(self):
-        for i in range(0, 53):
-            self.forward_step()
+        forward_step = self.forward_step
+        for _ in range(self.ANGLE_STEPS):
+            forward_step()
 
     def terminate(self):
         self.stop_thread = True
 
+    def _wait_until(self, deadline):
+        """
+        Blocks until the given monotonic deadline.  Sleeps for the bulk of the delay and spins for the final stretch so
+        step edges land on schedule instead of drifting by the sleep overshoot.
+        :param deadline: A time.monotonic() timestamp to wait for.
+        :returns: The time.monotonic() reading taken when the deadline was reached.
+        """
+        now = time.monotonic()
+        if deadline - now > self.spin_threshold:
+            time.sleep(deadline - now - self.spin_threshold)
+            now = time.monotonic()
+        while now < deadline:
+            now = time.monotonic()
+        return now
+
     def forward_step(self):
+        now = time.monotonic()
+        if now - self._next_edge > self.step_width:
+            self._next_edge = now
         gpio.output(self.STEP, gpio.HIGH)
-        time.sleep(self.step_width)
+        self._next_edge += self.step_width
+        self._wait_until(self._next_edge)
         gpio.output(self.STEP, gpio.LOW)
-        time.sleep(self.step_width)
+        self._next_edge += self.step_width
+        self._wait_until(self._next_edge)
 
     def dispense_treat(self):
         """
         Function to dispense a single treat.  Should not be used directly, use dispense_treats for error handling.
         :returns: True for successful dispensation of a single treat, False for a failure to dispense the treat.
         """
+        # Bind everything the step loop touches up front, the loop body only does local lookups
+        output, monotonic, wait_until = gpio.output, time.monotonic, self._wait_until
+        event_detected, treat_pin = gpio.event_detected, self.TREAT
+        step_pin, high, low = self.STEP, gpio.HIGH, gpio.LOW
+        width, timeout = self.step_width, self.dispensing_timeout
         if self.step_check < 0:
             self.step_check = 0
-        self.step_check += 54
-        self.start = time.time()
-        self.dispensing = True
-        while self.dispensing:
-            if time.time() - self.start > self.dispensing_timeout:
+        self.step_check += self.TREAT_STEPS
+        # Discard any break beam edge latched while the wheel was idle
+        event_detected(treat_pin)
+        start = self.start = monotonic()
+        edge = self._next_edge
+        now = start
+        while self.step_check > 0:
+            if now - start > timeout:
+                self._next_edge = edge
                 return False
-            self.forward_step()
+            if now - edge > width:
+                edge = now
+            output(step_pin, high)
+            edge += width
+            wait_until(edge)
+            output(step_pin, low)
+            edge += width
+            now = wait_until(edge)
             self.step_check -= 1
-            if self.dispensing and self.step_check == 0:
-                self.dispensing = False
+            if event_detected(treat_pin):
+                break
+        self._next_edge = edge
         return True
 
     def dispense_treats(self, num_treats):
@@ -97,21 +146,38 @@ class PreciseDispenser:
         """
         if num_treats > self.loaded_treats:
             raise ValueError("Not enough treats remaining to dispense {0} treats!".format(num_treats))
-        while num_treats is not 0:
-            if self.dispense_treat():
-                num_treats -= 1
-                self.loaded_treats -= 1
-            else:
-                raise ValueError("Treat was unable to dispense, {0} treats remaining with {1} treats in jogger, check for jams!".format(num_treats, self.loaded_treats))
-
-    def treat_dispensed(self, channel):
+        previous_scheduler = self._enter_realtime()
+        try:
+            while num_treats:
+                if self.dispense_treat():
+                    num_treats -= 1
+                    self.loaded_treats -= 1
+                else:
+                    raise ValueError("Treat was unable to dispense, {0} treats remaining with {1} treats in jogger, check for jams!".format(num_treats, self.loaded_treats))
+        finally:
+            self._exit_realtime(previous_scheduler)
+
+    def _enter_realtime(self):
+        """
+        Moves the calling thread to the SCHED_FIFO real-time policy so step edges are not delayed by normal priority tasks.
+        Needs root or CAP_SYS_NICE, without it the thread is left at its current priority.
+        :returns: The previous (policy, param) pair to pass to _exit_realtime, or None if the policy was not changed.
+        """
+        try:
+            previous = (os.sched_getscheduler(0), os.sched_getparam(0))
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self.realtime_priority))
+        except (AttributeError, OSError):
+            return None
+        return previous
+
+    def _exit_realtime(self, previous):
         """
-        A callback function for when a treat is dispensed.  This is detected on the falling edge of the IR break beam.
-        :param channel: The channel to identify the callback source.
+        Restores the scheduling policy saved by _enter_realtime.
+        :param previous: The value returned by _enter_realtime.
         :returns: None.
         """
-        self.start = time.time()
-        self.dispensing = False
+        if previous is not None:
+            os.sched_setscheduler(0, *previous)
 
     def close(self):
         """Closes the dispenser object and cleans up the GPIO assignments.